@@ -1,10 +1,28 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, HTMLResponse
-from fastapi.templating import Jinja2Templates
-from datetime import datetime
-from web3 import Web3
-from .abi import CONTRACT_ABI
+from fastapi.responses import HTMLResponse, Response
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+from datetime import datetime, timezone
+from functools import lru_cache
+from async_lru import alru_cache
+import aiohttp
+from web3 import AsyncWeb3, AsyncHTTPProvider, WebSocketProvider
+from web3.exceptions import (
+    ContractLogicError,
+    PersistentConnectionError,
+    ProviderConnectionError,
+    TimeExhausted,
+    Web3RPCError
+)
+from websockets.exceptions import ConnectionClosed
+from eth_abi import decode, encode
+from eth_abi.exceptions import DecodingError, EncodingError
+from eth_utils import function_signature_to_4byte_selector
+from eth_utils.abi import collapse_if_tuple
+from .abi import CONTRACT_ABI, MULTICALL3_ABI, MULTICALL3_ADDRESS
+import asyncio
+import hashlib
+import orjson
 import os
 
 app = FastAPI(
@@ -14,27 +32,91 @@ app = FastAPI(
 
 # Configurazione Web3 - Assicurati di impostare queste variabili su Railway
 RPC_URL = os.getenv("RPC_URL", "https://sepolia.base.org")
+WS_URL = os.getenv("WS_RPC_URL") # Se impostato, usiamo una connessione WebSocket persistente
 CONTRACT_ADDRESS = os.getenv("CONTRACT_ADDRESS") # L'indirizzo del contratto deployato
+WEI_PER_ETHER = 10**18
 IPFS_BASE_CID = "ipfs://bafybeice35pax2yc3pcwjdh445g7eol7lag4z4aalpgquv6bpdjdz6m7ja"
-# Inizializzazione Web3
-w3 = Web3(Web3.HTTPProvider(RPC_URL))
+# Durata della cache dei dati on-chain
+SONG_CACHE_TTL = float(os.getenv("SONG_CACHE_TTL", "12"))
+# Pool di connessioni keep-alive verso il nodo RPC
+RPC_POOL_LIMIT = int(os.getenv("RPC_POOL_LIMIT", "100"))
+RPC_POOL_PER_HOST = int(os.getenv("RPC_POOL_PER_HOST", "100"))
+RPC_KEEPALIVE_TIMEOUT = float(os.getenv("RPC_KEEPALIVE_TIMEOUT", "60"))
+# Tentativi extra (con backoff esponenziale) sugli errori di rete verso il nodo RPC
+RPC_RETRIES = int(os.getenv("RPC_RETRIES", "3"))
+# Timeout di ogni singola richiesta al nodo RPC, in secondi
+RPC_TIMEOUT = float(os.getenv("RPC_TIMEOUT", "10"))
+# Inizializzazione Web3: WebSocket se disponibile, altrimenti HTTP.
+# I retry restano solo in eth_call_with_retry: quelli interni di AsyncHTTPProvider sono disattivati
+if WS_URL:
+    w3 = AsyncWeb3(WebSocketProvider(WS_URL, request_timeout=RPC_TIMEOUT))
+else:
+    w3 = AsyncWeb3(AsyncHTTPProvider(
+        RPC_URL,
+        request_kwargs={"timeout": aiohttp.ClientTimeout(total=RPC_TIMEOUT)},
+        exception_retry_configuration=None
+    ))
 
 
 
 # Mapping degli stati e delle immagini IPFS corrispondenti 
 LIFECYCLE_MAP = {
-    0: {"name": "Upload", "file": "upload.jpg"},
-    1: {"name": "Collaborate", "file": "collaborate.jpg"},
-    2: {"name": "Register", "file": "register.jpg"},
-    3: {"name": "Publish", "file": "publish.jpg"},
-    4: {"name": "Revenue", "file": "revenue.jpg"}
+    0: {"name": "Upload", "file": "upload.jpg", "color": "bg-slate-500"},
+    1: {"name": "Collaborate", "file": "collaborate.jpg", "color": "bg-blue-600"},
+    2: {"name": "Register", "file": "register.jpg", "color": "bg-fuchsia-600"},
+    3: {"name": "Publish", "file": "publish.jpg", "color": "bg-emerald-500"},
+    4: {"name": "Revenue", "file": "revenue.jpg", "color": "bg-amber-500"}
 }
 
-contract = w3.eth.contract(
-    address=Web3.to_checksum_address(CONTRACT_ADDRESS),
-    abi=CONTRACT_ABI
+IPFS_GATEWAY_BASE = f"https://gateway.pinata.cloud/ipfs/{IPFS_BASE_CID.replace('ipfs://', '')}"
+
+# Per ogni stato: (nome, immagine ipfs://, immagine via gateway, colore del badge), costruiti una volta sola
+LIFECYCLE = tuple(
+    (info["name"], f"{IPFS_BASE_CID}/{info['file']}", f"{IPFS_GATEWAY_BASE}/{info['file']}", info["color"])
+    for _, info in sorted(LIFECYCLE_MAP.items())
+)
+
+# Parte statica dei metadati per ogni stato: per richiesta si aggiungono solo i campi dinamici
+METADATA_SKELETON = tuple(
+    {
+        "description": f"This song is currently in the {name} phase.",
+        "image": image_url,
+        "attributes_base": ({"trait_type": "Lifecycle State", "value": name},)
+    }
+    for name, image_url, _, _ in LIFECYCLE
 )
 
+def state_slot(state_index: int) -> int:
+    return state_index if 0 <= state_index < len(LIFECYCLE) else 0
+
+def lifecycle_state(state_index: int):
+    return LIFECYCLE[state_slot(state_index)]
+
+@lru_cache(maxsize=1024)
+def format_pub_date(ts: int) -> str:
+    return datetime.fromtimestamp(ts, tz=timezone.utc).strftime('%d %b %Y') if ts > 0 else "Pending"
+
+CONTRACT_ADDRESS = AsyncWeb3.to_checksum_address(CONTRACT_ADDRESS)
+MULTICALL3_ADDRESS = AsyncWeb3.to_checksum_address(os.getenv("MULTICALL3_ADDRESS", MULTICALL3_ADDRESS))
+
+def abi_types(abi, fn_name: str, key: str = "outputs"):
+    fn_abi = next(item for item in abi if item.get("name") == fn_name)
+    return [collapse_if_tuple(param) for param in fn_abi[key]]
+
+def selector(abi, fn_name: str):
+    return function_signature_to_4byte_selector(f"{fn_name}({','.join(abi_types(abi, fn_name, 'inputs'))})")
+
+# Selettori e tipi ABI calcolati una volta sola: nel percorso caldo restano solo encode/decode
+GET_SONG_DATA_SELECTOR = selector(CONTRACT_ABI, "getSongData")
+GET_COLLABORATORS_SELECTOR = selector(CONTRACT_ABI, "getCollaborators")
+SONG_DATA_TYPES = abi_types(CONTRACT_ABI, "getSongData")
+COLLABORATORS_TYPES = abi_types(CONTRACT_ABI, "getCollaborators")
+NAME_SELECTOR = selector(CONTRACT_ABI, "name")
+SYMBOL_SELECTOR = selector(CONTRACT_ABI, "symbol")
+
+AGGREGATE3_SELECTOR = selector(MULTICALL3_ABI, "aggregate3")
+AGGREGATE3_INPUT_TYPES = abi_types(MULTICALL3_ABI, "aggregate3", "inputs")
+AGGREGATE3_OUTPUT_TYPES = abi_types(MULTICALL3_ABI, "aggregate3")
 
 app.add_middleware(
     CORSMiddleware,
@@ -43,72 +125,174 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.middleware("http")
-async def allow_only_get(request: Request, call_next):
-    if request.method != "GET":
-        return JSONResponse(status_code=405, content={"error": "Method not allowed"})
-    return await call_next(request)
+# Errori transitori del trasporto: si riprova invece di rispondere subito con un errore.
+# Su WebSocket un timeout è TimeExhausted e una socket caduta PersistentConnectionError/ConnectionClosed
+RPC_NETWORK_ERRORS = (
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+    ProviderConnectionError,
+    TimeExhausted,
+    PersistentConnectionError,
+    ConnectionClosed
+)
+
+async def eth_call_with_retry(tx):
+    for attempt in range(RPC_RETRIES + 1):
+        try:
+            return await w3.eth.call(tx)
+        except RPC_NETWORK_ERRORS:
+            if attempt == RPC_RETRIES:
+                raise
+            await asyncio.sleep(0.05 * 2 ** attempt)
+
+@alru_cache(maxsize=4096, ttl=SONG_CACHE_TTL)
+async def fetch_song(token_id: int):
+    """Legge getSongData e getCollaborators con un'unica eth_call aggregata via Multicall3.
+
+    Il risultato resta in cache per SONG_CACHE_TTL secondi: i marketplace interrogano
+    ripetutamente lo stesso tokenURI e i dati cambiano raramente tra un blocco e l'altro.
+    Essendo un'unica eth_call, le due letture vedono sempre lo stesso snapshot della catena.
+    alru_cache registra il future al primo miss, quindi richieste concorrenti per lo stesso
+    token_id attendono la stessa eth_call invece di aprirne una ciascuna (singleflight).
+    """
+    token_arg = encode(["uint256"], [token_id])
+    calls = [
+        (CONTRACT_ADDRESS, False, GET_SONG_DATA_SELECTOR + token_arg),
+        (CONTRACT_ADDRESS, False, GET_COLLABORATORS_SELECTOR + token_arg)
+    ]
+    raw = await eth_call_with_retry({
+        "to": MULTICALL3_ADDRESS,
+        "data": "0x" + (AGGREGATE3_SELECTOR + encode(AGGREGATE3_INPUT_TYPES, [calls])).hex()
+    })
+    (results,) = decode(AGGREGATE3_OUTPUT_TYPES, raw)
+    (_, song_raw), (_, collaborators_raw) = results
+
+    song_data = decode(SONG_DATA_TYPES, song_raw)
+    (collaborators,) = decode(COLLABORATORS_TYPES, collaborators_raw)
+    return song_data, collaborators
+
+async def load_song(token_id: int):
+    """Come fetch_song, ma traduce gli errori in risposte HTTP."""
+    try:
+        return await fetch_song(token_id)
+    except (ContractLogicError, DecodingError, EncodingError):
+        # Multicall3 fa revert se getSongData/getCollaborators falliscono (token inesistente);
+        # EncodingError: token_id fuori dal range di uint256
+        raise HTTPException(status_code=404, detail="Token not found")
+    except (*RPC_NETWORK_ERRORS, Web3RPCError):
+        # Web3RPCError: errori JSON-RPC del nodo (rate limit -32005, nodo non sincronizzato, ...)
+        raise HTTPException(status_code=503, detail="RPC node unavailable")
+
+@alru_cache(maxsize=1)
+async def fetch_contract_info():
+    """name() e symbol() non cambiano mai on-chain: li leggiamo una volta sola, al primo uso.
+
+    alru_cache non memorizza le eccezioni, quindi se l'RPC fallisce si riprova alla richiesta successiva.
+    """
+    name_raw, symbol_raw = await asyncio.gather(
+        eth_call_with_retry({"to": CONTRACT_ADDRESS, "data": "0x" + NAME_SELECTOR.hex()}),
+        eth_call_with_retry({"to": CONTRACT_ADDRESS, "data": "0x" + SYMBOL_SELECTOR.hex()})
+    )
+    (name,) = decode(abi_types(CONTRACT_ABI, "name"), name_raw)
+    (symbol,) = decode(abi_types(CONTRACT_ABI, "symbol"), symbol_raw)
+    return {"address": CONTRACT_ADDRESS, "name": name, "symbol": symbol}
+
+@app.on_event("startup")
+async def open_rpc_connection():
+    if WS_URL:
+        # Una sola socket persistente multiplexa tutte le richieste JSON-RPC
+        await w3.provider.connect()
+    else:
+        # Un'unica sessione aiohttp condivisa: il handshake TCP/TLS si paga una volta sola
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(
+                limit=RPC_POOL_LIMIT,
+                limit_per_host=RPC_POOL_PER_HOST,
+                keepalive_timeout=RPC_KEEPALIVE_TIMEOUT
+            )
+        )
+        await w3.provider.cache_async_session(session)
+        app.state.rpc_session = session
+
+@app.on_event("shutdown")
+async def close_rpc_connection():
+    if WS_URL:
+        await w3.provider.disconnect()
+    else:
+        await app.state.rpc_session.close()
+
+def etag_matches(if_none_match, etag: str) -> bool:
+    """Confronto debole di If-None-Match (RFC 9110): lista separata da virgole, W/ ignorato, * accetta tutto."""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
 
 @app.get("/")
 async def root():
     return {"status": "ok", "network": "Base Sepolia"}
 
-@app.get("/metadata/{token_id}")
-async def get_nft_metadata(token_id: int):
+@app.get("/contract")
+async def get_contract_info():
     try:
-        song_data = contract.functions.getSongData(token_id).call()
-        collaborators = contract.functions.getCollaborators(token_id).call()
-
-        # Unpack dei dati dal contratto
-        state_index = song_data[0]
-        published_at = song_data[1]
-        streams = song_data[2]
-        revenue = song_data[3]
-        audio_hash = song_data[4]
-        spotify_id = song_data[5]
-
-        state_info = LIFECYCLE_MAP.get(state_index, LIFECYCLE_MAP[0])
-        
-        # 1. Costruzione base dei metadati
-        metadata = {
-            "name": f"Spyral Song #{token_id}",
-            "description": f"This song is currently in the {state_info['name']} phase.",
-            "image": f"{IPFS_BASE_CID}/{state_info['file']}",
-            "external_url": f"https://spyral.com/song/{token_id}",
-            "attributes": [
-                {"trait_type": "Lifecycle State", "value": state_info["name"]}
-            ]
-        }
-
-        # 2. Aggiunta dinamica degli attributi in base allo stato (state_index)
-        # Stato 0: Upload (mostriamo solo l'hash audio se presente)
-        if state_index >= 0:
-            if audio_hash and any(b != 0 for b in audio_hash):
-                metadata["attributes"].append({"trait_type": "Audio Hash", "value": Web3.to_hex(audio_hash)})
-
-        # Stato 1: Collaborate
-        if state_index >= 1:
-            metadata["attributes"].append({"trait_type": "Collaborators", "value": len(collaborators)})
-
-        # Stato 2 e 3: Register & Publish
-        if state_index >= 2:
-            if spotify_id and spotify_id != "":
-                metadata["attributes"].append({"trait_type": "Spotify ID", "value": spotify_id})
-            if published_at > 0:
-                metadata["attributes"].append({"trait_type": "Published Date", "display_type": "date", "value": published_at})
-
-        # Stato 4: Revenue
-        if state_index >= 4:
-            metadata["attributes"].append({"trait_type": "Stream Count", "display_type": "number", "value": streams})
-            metadata["attributes"].append({"trait_type": "Revenue Generated", "value": float(w3.from_wei(revenue, 'ether'))})
-
-        return metadata
-
-    except Exception as e:
-        raise HTTPException(
-            status_code=404,
-            detail=f"Token {token_id} not found or error: {str(e)}"
-        )
+        return await fetch_contract_info()
+    except (*RPC_NETWORK_ERRORS, Web3RPCError, ContractLogicError, DecodingError):
+        raise HTTPException(status_code=503, detail="Contract info not available yet")
+
+@app.get("/metadata/{token_id}")
+async def get_nft_metadata(request: Request, token_id: int):
+    song_data, collaborators = await load_song(token_id)
+
+    # Unpack dei dati dal contratto
+    state_index = song_data[0]
+    published_at = song_data[1]
+    streams = song_data[2]
+    revenue = song_data[3]
+    audio_hash = song_data[4]
+    spotify_id = song_data[5]
+
+    skeleton = METADATA_SKELETON[state_slot(state_index)]
+
+    # 1. Costruzione base dei metadati (parte statica precalcolata per stato)
+    metadata = {
+        "name": f"Spyral Song #{token_id}",
+        "description": skeleton["description"],
+        "image": skeleton["image"],
+        "external_url": f"https://spyral.com/song/{token_id}",
+        "attributes": list(skeleton["attributes_base"])
+    }
+
+    # 2. Aggiunta dinamica degli attributi in base allo stato (state_index)
+    # Stato 0: Upload (mostriamo solo l'hash audio se presente)
+    if state_index >= 0:
+        if audio_hash and any(b != 0 for b in audio_hash):
+            metadata["attributes"].append({"trait_type": "Audio Hash", "value": "0x" + audio_hash.hex()})
+
+    # Stato 1: Collaborate
+    if state_index >= 1:
+        metadata["attributes"].append({"trait_type": "Collaborators", "value": len(collaborators)})
+
+    # Stato 2 e 3: Register & Publish
+    if state_index >= 2:
+        if spotify_id and spotify_id != "":
+            metadata["attributes"].append({"trait_type": "Spotify ID", "value": spotify_id})
+        if published_at > 0:
+            metadata["attributes"].append({"trait_type": "Published Date", "display_type": "date", "value": published_at})
+
+    # Stato 4: Revenue
+    if state_index >= 4:
+        metadata["attributes"].append({"trait_type": "Stream Count", "display_type": "number", "value": streams})
+        metadata["attributes"].append({"trait_type": "Revenue Generated", "value": revenue / WEI_PER_ETHER})
+
+    # 3. ETag per permettere a client e CDN di evitare il download se nulla è cambiato
+    body = orjson.dumps(metadata)
+    etag = f'"{hashlib.sha256(body).hexdigest()[:16]}"'
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
     
 
 
@@ -116,33 +300,40 @@ base_path = os.path.dirname(os.path.abspath(__file__))
 
 template_path = os.path.join(base_path, "templates")
 
-templates = Jinja2Templates(directory=template_path)
+jinja_cache_path = os.path.join(base_path, ".jinja_cache")
+os.makedirs(jinja_cache_path, exist_ok=True)
+
+# Template compilato una volta all'avvio e renderizzato in modo asincrono
+templates = Environment(
+    loader=FileSystemLoader(template_path),
+    autoescape=True,
+    enable_async=True,
+    bytecode_cache=FileSystemBytecodeCache(jinja_cache_path)
+)
+nft_view_template = templates.get_template("nft_view.html")
+
 @app.get("/view/{token_id}", response_class=HTMLResponse)
-async def view_nft_modern(request: Request, token_id: int):
-    try:
-        # 1. Fetch Dati
-        song_data = contract.functions.getSongData(token_id).call()
-        state_idx = song_data[0]
-        state_info = LIFECYCLE_MAP.get(state_idx, LIFECYCLE_MAP[0])
-        
-        # 2. Preparazione variabili per il template
-
-        context = {
-            "request": request,
-            "token_id": token_id,
-            "state_name": state_info["name"],
-            "image_url": f"https://gateway.pinata.cloud/ipfs/{IPFS_BASE_CID.replace('ipfs://', '')}/{state_info['file']}",
-            "streams": song_data[2],
-            "revenue": round(float(w3.from_wei(song_data[3], 'ether')), 4),
-            "spotify_id": song_data[5],
-            "pub_date": datetime.fromtimestamp(song_data[1]).strftime('%d %b %Y') if song_data[1] > 0 else "Pending",
-            "progress": int(((state_idx + 1) / 5) * 100),
-            "status_color": ["bg-slate-500", "bg-blue-600", "bg-fuchsia-600", "bg-emerald-500", "bg-amber-500"][state_idx]
-        }
-        
-        
-        # 3. Renderizza il file HTML passandogli il dizionario 'context'
-        return templates.TemplateResponse("nft_view.html", context)
-
-    except Exception as e:
-        raise HTTPException(status_code=404, detail=str(e))
\ No newline at end of file
+async def view_nft_modern(token_id: int):
+    # 1. Fetch Dati
+    song_data, _ = await load_song(token_id)
+    state_idx = song_data[0]
+    state_name, _, image_url, status_color = lifecycle_state(state_idx)
+
+    # 2. Preparazione variabili per il template
+
+    context = {
+        "token_id": token_id,
+        "state_name": state_name,
+        "image_url": image_url,
+        "streams": song_data[2],
+        "revenue": round(song_data[3] / WEI_PER_ETHER, 4),
+        "spotify_id": song_data[5],
+        "pub_date": format_pub_date(song_data[1]),
+        "progress": int(((state_idx + 1) / 5) * 100),
+        "status_color": status_color
+    }
+
+
+    # 3. Renderizza il file HTML passandogli il dizionario 'context'
+    html = await nft_view_template.render_async(context)
+    return HTMLResponse(html)
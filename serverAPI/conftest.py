@@ -0,0 +1,4 @@
+import os
+
+# main.py legge CONTRACT_ADDRESS all'import: valore fittizio, nessuna chiamata RPC reale nei test
+os.environ.setdefault("CONTRACT_ADDRESS", "0x000000000000000000000000000000000000dEaD")
@@ -0,0 +1,281 @@
+import asyncio
+import time
+
+import aiohttp
+import pytest
+from eth_abi import decode, encode
+from fastapi import HTTPException
+from fastapi.testclient import TestClient
+from web3.exceptions import ContractLogicError, PersistentConnectionError, TimeExhausted, Web3RPCError
+from websockets.exceptions import ConnectionClosedError
+
+from app import main
+
+# Tipi ABI e selettori scritti a mano: i test non dipendono da come main.py li calcola
+SONG_DATA_TYPES = ["uint8", "uint64", "uint128", "uint128", "bytes32", "string"]
+COLLABORATORS_TYPES = ["(address,uint8)[]"]
+AGGREGATE3_SELECTOR = bytes.fromhex("82ad56cb")
+AGGREGATE3_INPUT_TYPES = ["(address,bool,bytes)[]"]
+AGGREGATE3_OUTPUT_TYPES = ["(bool,bytes)[]"]
+NAME_SELECTOR = bytes.fromhex("06fdde03")
+SYMBOL_SELECTOR = bytes.fromhex("95d89b41")
+
+SONG = (4, 1700000000, 1234, 5 * 10**17, b"\x11" * 32, "spotify123")
+COLLABORATORS = [("0x000000000000000000000000000000000000bEEF", 50)]
+
+
+def call_data(tx):
+    data = tx["data"]
+    return bytes.fromhex(data[2:]) if isinstance(data, str) else bytes(data)
+
+
+class FakeRPC:
+    """Sostituto di w3.eth.call: risponde a name()/symbol() e ad aggregate3 con i dati di `song`."""
+
+    def __init__(self):
+        self.calls = []
+        self.song = SONG
+        self.handler = self.multicall_response
+
+    def multicall_response(self, tx, block):
+        data = call_data(tx)
+        if data == NAME_SELECTOR:
+            return encode(["string"], ["SpyralSong"])
+        if data == SYMBOL_SELECTOR:
+            return encode(["string"], ["SPY"])
+        assert data[:4] == AGGREGATE3_SELECTOR
+        (calls,) = decode(AGGREGATE3_INPUT_TYPES, data[4:])
+        assert len(calls) == 2
+        song_raw = encode(SONG_DATA_TYPES, list(self.song))
+        collaborators_raw = encode(COLLABORATORS_TYPES, [COLLABORATORS])
+        return encode(AGGREGATE3_OUTPUT_TYPES, [[(True, song_raw), (True, collaborators_raw)]])
+
+
+@pytest.fixture
+def rpc(monkeypatch):
+    fake = FakeRPC()
+
+    async def fake_call(tx, block_identifier="latest", **kwargs):
+        fake.calls.append(block_identifier)
+        await asyncio.sleep(0)  # cede il loop come una vera richiesta di rete
+        return fake.handler(tx, block_identifier)
+
+    monkeypatch.setattr(main.w3.eth, "call", fake_call)
+    main.fetch_song.cache_clear()
+    main.fetch_contract_info.cache_clear()
+    return fake
+
+
+@pytest.fixture
+def client(rpc):
+    with TestClient(main.app) as test_client:
+        rpc.calls.clear()  # contiamo solo le chiamate fatte dalle richieste del test
+        yield test_client
+
+
+def test_metadata_ok(rpc, client):
+    response = client.get("/metadata/1")
+
+    assert response.status_code == 200
+    body = response.json()
+    assert body["name"] == "Spyral Song #1"
+    assert body["image"].endswith("/revenue.jpg")
+    assert {"trait_type": "Audio Hash", "value": "0x" + "11" * 32} in body["attributes"]
+    assert {"trait_type": "Revenue Generated", "value": 0.5} in body["attributes"]
+    assert response.headers["ETag"]
+    assert len(rpc.calls) == 1
+
+
+def test_metadata_is_cached(rpc, client):
+    client.get("/metadata/1")
+    client.get("/metadata/1")
+    client.get("/view/1")
+
+    assert len(rpc.calls) == 1
+
+
+def test_missing_token_returns_404(rpc, client):
+    def revert(tx, block):
+        raise ContractLogicError("execution reverted: Multicall3: call failed")
+    rpc.handler = revert
+
+    assert client.get("/metadata/99").status_code == 404
+    assert client.get("/view/99").status_code == 404
+
+
+@pytest.mark.parametrize("token_id", [-1, 2**256])
+def test_out_of_range_token_returns_404(rpc, client, token_id):
+    assert client.get(f"/metadata/{token_id}").status_code == 404
+    assert client.get(f"/view/{token_id}").status_code == 404
+    assert rpc.calls == []
+
+
+def test_rpc_error_returns_503_without_retry(rpc, client):
+    def rate_limited(tx, block):
+        raise Web3RPCError("rate limit exceeded")
+    rpc.handler = rate_limited
+
+    assert client.get("/metadata/1").status_code == 503
+    assert len(rpc.calls) == 1
+
+
+def test_transport_error_returns_503_after_bounded_retries(rpc, client):
+    def fail(tx, block):
+        raise aiohttp.ClientConnectionError("connection reset")
+    rpc.handler = fail
+
+    response = client.get("/metadata/5")
+
+    assert response.status_code == 503
+    assert len(rpc.calls) == main.RPC_RETRIES + 1
+
+
+@pytest.mark.parametrize("error", [
+    TimeExhausted("request timed out"),
+    PersistentConnectionError("connection lost"),
+    ConnectionClosedError(None, None),
+])
+def test_websocket_errors_are_retried_then_503(rpc, client, error):
+    def fail(tx, block):
+        raise error
+    rpc.handler = fail
+
+    assert client.get("/metadata/5").status_code == 503
+    assert len(rpc.calls) == main.RPC_RETRIES + 1
+    assert client.get("/contract").status_code == 503
+
+
+def test_http_provider_does_not_add_its_own_retries(monkeypatch):
+    # Nodo finto che chiude ogni connessione: conta quante richieste HTTP arrivano davvero
+    async def scenario():
+        hits = 0
+
+        async def drop(reader, writer):
+            nonlocal hits
+            hits += 1
+            writer.close()
+
+        server = await asyncio.start_server(drop, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        monkeypatch.setattr(main.w3.provider, "endpoint_uri", f"http://127.0.0.1:{port}")
+        main.fetch_song.cache_clear()
+        try:
+            with pytest.raises(HTTPException) as error:
+                await main.load_song(5)
+        finally:
+            server.close()
+        return error.value.status_code, hits
+
+    status_code, hits = asyncio.run(scenario())
+
+    assert status_code == 503
+    assert hits == main.RPC_RETRIES + 1
+
+
+def test_concurrent_requests_share_one_rpc_call(rpc):
+    async def burst():
+        return await asyncio.gather(*(main.fetch_song(7) for _ in range(50)))
+
+    results = asyncio.run(burst())
+
+    assert len(rpc.calls) == 1
+    assert all(result == results[0] for result in results)
+
+
+@pytest.mark.parametrize("if_none_match", ["{etag}", "W/{etag}", '"other", {etag}', "*"])
+def test_if_none_match_returns_304(rpc, client, if_none_match):
+    etag = client.get("/metadata/1").headers["ETag"]
+
+    response = client.get("/metadata/1", headers={"If-None-Match": if_none_match.format(etag=etag)})
+
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+
+
+def test_if_none_match_mismatch_returns_200(rpc, client):
+    response = client.get("/metadata/1", headers={"If-None-Match": '"deadbeef"'})
+
+    assert response.status_code == 200
+
+
+def test_view_ok(rpc, client):
+    response = client.get("/view/1")
+
+    assert response.status_code == 200
+    assert "spotify123" in response.text
+    assert "revenue.jpg" in response.text
+    assert "14 Nov 2023" in response.text
+
+
+def test_pub_date_is_formatted_in_utc(monkeypatch):
+    # 1700006400 = 15 Nov 2023 00:00 UTC, ancora 14 Nov a New York
+    monkeypatch.setenv("TZ", "America/New_York")
+    time.tzset()
+    main.format_pub_date.cache_clear()
+    try:
+        assert main.format_pub_date(1700006400) == "15 Nov 2023"
+        assert main.format_pub_date(0) == "Pending"
+    finally:
+        monkeypatch.undo()
+        time.tzset()
+
+
+def test_view_unknown_state_falls_back_to_upload(rpc, client):
+    rpc.song = (7,) + SONG[1:]
+
+    response = client.get("/view/1")
+
+    assert response.status_code == 200
+    assert "upload.jpg" in response.text
+    assert "bg-slate-500" in response.text
+
+
+@pytest.mark.parametrize("method", ["POST", "PUT", "DELETE", "HEAD"])
+def test_non_get_methods_return_405(client, method):
+    response = client.request(method, "/metadata/1")
+
+    assert response.status_code == 405
+    assert response.headers["Allow"] == "GET"
+
+
+ALL_TRAITS = ["Lifecycle State", "Audio Hash", "Collaborators", "Spotify ID", "Published Date",
+              "Stream Count", "Revenue Generated"]
+
+
+@pytest.mark.parametrize("state_index, state_name, image, traits", [
+    (0, "Upload", "upload.jpg", ALL_TRAITS[:2]),
+    (1, "Collaborate", "collaborate.jpg", ALL_TRAITS[:3]),
+    (2, "Register", "register.jpg", ALL_TRAITS[:5]),
+    (3, "Publish", "publish.jpg", ALL_TRAITS[:5]),
+    (4, "Revenue", "revenue.jpg", ALL_TRAITS),
+    # Stato sconosciuto: parte statica di Upload, attributi dinamici secondo state_index
+    (7, "Upload", "upload.jpg", ALL_TRAITS),
+])
+def test_metadata_per_state(rpc, client, state_index, state_name, image, traits):
+    rpc.song = (state_index,) + SONG[1:]
+
+    body = client.get("/metadata/3").json()
+
+    assert body["name"] == "Spyral Song #3"
+    assert body["description"] == f"This song is currently in the {state_name} phase."
+    assert body["image"] == f"{main.IPFS_BASE_CID}/{image}"
+    assert body["external_url"] == "https://spyral.com/song/3"
+    assert body["attributes"][0] == {"trait_type": "Lifecycle State", "value": state_name}
+    assert [attribute["trait_type"] for attribute in body["attributes"]] == traits
+
+
+def test_contract_info(rpc, client):
+    response = client.get("/contract")
+
+    assert response.status_code == 200
+    assert response.json() == {"address": main.CONTRACT_ADDRESS, "name": "SpyralSong", "symbol": "SPY"}
+
+
+def test_contract_info_is_loaded_lazily(rpc, client):
+    def unavailable(tx, block):
+        raise aiohttp.ClientConnectionError("connection reset")
+    rpc.handler = unavailable
+    assert client.get("/contract").status_code == 503
+
+    rpc.handler = rpc.multicall_response
+    assert client.get("/contract").status_code == 200